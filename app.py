@@ -2,20 +2,31 @@ import os
 import re
 import json
 import ast
-import uuid
+import csv
+import hashlib
 import io
 import inspect
+import random
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
 from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
 import streamlit as st
-from PIL import Image
 
+# PIL / google.generativeai は AI登録を使うときだけ import する（ensure_gemini / _preprocess_image）
 try:
-    import google.generativeai as genai
+    from dotenv import load_dotenv
 except Exception:
-    genai = None
+    load_dotenv = None
+try:
+    # 並列解析のワーカースレッドからも st.cache_data を使うため
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except Exception:
+    add_script_run_ctx = None
+    get_script_run_ctx = None
 import platform
 from pathlib import Path
 
@@ -69,6 +80,14 @@ import db
 # =========================================================
 # API keys from server environment (ENV_GEMINI は必ずここで定義・NameError 防止)
 # =========================================================
+@st.cache_resource(show_spinner=False)
+def _load_dotenv_once() -> bool:
+    """ローカル起動用の .env を読むのはプロセスで1回だけ（既存の環境変数は上書きしない）"""
+    if load_dotenv is None:
+        return False
+    return bool(load_dotenv(Path(__file__).resolve().parent / ".env", override=False))
+
+_load_dotenv_once()
 ENV_GEMINI = (os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY") or "").strip()
 ENV_OPENAI = (os.getenv("OPENAI_API_KEY") or "").strip()
 
@@ -91,6 +110,9 @@ ss_init("current_page", "home")
 ss_init("inv_cat", None)
 ss_init("pending_items", [])  # AI結果カート（未登録）
 ss_init("ai_last_raw", "")    # デバッグ用：AI生出力
+ss_init("ai_notice", None)     # AI解析結果の表示（カート追加後の rerun をまたいで渡す）
+ss_init("ai_failed", [])       # 再試行しても失敗した画像（name / sha256）。「失敗分だけ再解析」に使う
+ss_init("cart_seq", 0)        # カート行ID（_tmp_id）の連番。セッション内で再利用しない
 # If session already exists but empty, hydrate from env
 if not st.session_state.get("api_key") and ENV_GEMINI:
     st.session_state["api_key"] = ENV_GEMINI
@@ -106,12 +128,12 @@ def navigate_to(page: str) -> None:
 # UI helper
 # =========================================================
 _SUPPORTS_WIDTH = "width" in inspect.signature(st.button).parameters
+# 横幅指定の引数は版で違うので、どちらを渡すかは起動時に1回だけ決める
+_STRETCH_KW: Dict[str, Any] = {"width": "stretch"} if _SUPPORTS_WIDTH else {"use_container_width": True}
 
 def button_stretch(label: str, *, key: str, type: str = "secondary", **kwargs) -> bool:
     """ボタンを横幅いっぱいに広げる"""
-    if _SUPPORTS_WIDTH:
-        return st.button(label, key=key, type=type, width="stretch", **kwargs)
-    return st.button(label, key=key, type=type, use_container_width=True, **kwargs)
+    return st.button(label, key=key, type=type, **_STRETCH_KW, **kwargs)
 
 # =========================================================
 # Constants
@@ -127,12 +149,23 @@ CATEGORIES: Dict[str, str] = {
 }
 DUE_LABEL = {"expiry": "賞味期限", "inspection": "点検日", "none": "期限なし"}
 TOILET_SUBTYPES = ["携帯トイレ", "組立トイレ", "仮設トイレ", "トイレ袋", "凝固剤", "その他"]
+# 点検 6-5 で「基数」として数える種別
+TOILET_UNIT_SUBTYPES = ["仮設トイレ", "組立トイレ"]
+# 登録済みリストの表（列名 → 表示名）
+STOCK_TABLE_COLS = {
+    "name": "品名",
+    "qty": "数量",
+    "unit": "単位",
+    "due_type": "期限種別",
+    "due_date": "期限日",
+    "subtype": "種別",
+    "memo": "メモ",
+}
 
 # =========================================================
 # CSS（iPhoneノッチ + 反応しない問題対策）
 # =========================================================
-st.markdown(
-    """
+APP_CSS = """
 <style>
 html { -webkit-text-size-adjust: 100%; }
 .stApp { background-color: #f8fafc; }
@@ -225,9 +258,11 @@ div.element-container[class*="st-key-back_"] div.stButton>button {
 #MainMenu {visibility:hidden;}
 footer {visibility:hidden;}
 </style>
-""",
-    unsafe_allow_html=True,
-)
+"""
+
+# 注意: Streamlit は再実行のたびに要素を描き直すため、初回だけ送る方式にすると
+# 2回目以降の再実行でスタイルが消える。文字列は定数にして毎回そのまま渡す。
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # =========================================================
 # Sidebar settings
@@ -282,11 +317,53 @@ if EFFECTIVE_GEMINI_KEY:
     st.session_state["api_key"] = EFFECTIVE_GEMINI_KEY
 
 # Configure Gemini (REST transport)
-if genai is not None and EFFECTIVE_GEMINI_KEY.startswith("AIza"):
+# genai.configure はプロセス全体の設定なので、直近に設定したキーと同じなら再実行しない
+@st.cache_resource(show_spinner=False)
+def _gemini_configured() -> Dict[str, str]:
+    return {}
+
+@st.cache_resource(show_spinner=False)
+def _retryable_gemini_errors() -> Tuple[type, ...]:
+    """少し待てば通りうる API 例外（429 / 一時的な 5xx）。api_core が無い環境では空（HTTP コードだけで判定）。"""
     try:
-        genai.configure(api_key=EFFECTIVE_GEMINI_KEY, transport="rest")
+        from google.api_core import exceptions as gexc
     except Exception:
-        genai.configure(api_key=EFFECTIVE_GEMINI_KEY)
+        return ()
+    return (gexc.ResourceExhausted, gexc.TooManyRequests, gexc.ServiceUnavailable, gexc.InternalServerError)
+
+@st.cache_resource(show_spinner=False)
+def _transient_network_errors() -> Tuple[type, ...]:
+    """タイムアウト/接続断。自動では再試行しないが、ユーザーが押し直せば通りうる。"""
+    errs: List[type] = [TimeoutError, ConnectionError]
+    try:
+        from google.api_core import exceptions as gexc
+        errs.append(gexc.DeadlineExceeded)
+    except Exception:
+        pass
+    try:
+        import requests
+        errs += [requests.exceptions.Timeout, requests.exceptions.ConnectionError]
+    except Exception:
+        pass
+    return tuple(errs)
+
+def ensure_gemini():
+    """
+    AI機能を使う直前に呼ぶ：google.generativeai を遅延 import し、キーが変わったときだけ configure。
+    未インストールなら None。
+    """
+    try:
+        import google.generativeai as genai
+    except Exception:
+        return None
+    cfg = _gemini_configured()
+    if EFFECTIVE_GEMINI_KEY.startswith("AIza") and cfg.get("key") != EFFECTIVE_GEMINI_KEY:
+        try:
+            genai.configure(api_key=EFFECTIVE_GEMINI_KEY, transport="rest")
+        except Exception:
+            genai.configure(api_key=EFFECTIVE_GEMINI_KEY)
+        cfg["key"] = EFFECTIVE_GEMINI_KEY
+    return genai
 
 TARGETS = {
     "水・飲料": t_pop * 3 * t_days,
@@ -297,60 +374,173 @@ TARGETS = {
 # =========================================================
 # DB & aggregation
 # =========================================================
-db.init_db()
-stocks = db.get_all_stocks() or []
+# スキーマ確認・NULL正規化・index作成は再実行ごとに要らない（プロセスにつき1回）。
+@st.cache_resource(show_spinner=False)
+def _init_db_once() -> bool:
+    db.init_db()
+    return True
+
+_init_db_once()
 today = datetime.now().date()
 
+# カテゴリ名の交互パターン（1回の走査で全キーを探す）。
+# 複数ヒット時は従来どおり CATEGORIES の定義順で先のキーを優先する。
+_CAT_RE = re.compile("|".join(map(re.escape, CATEGORIES)))
+_CAT_ORDER = {k: i for i, k in enumerate(CATEGORIES)}
+
 def get_cat_key(c: Any) -> str:
     s = str(c or "")
-    for k in CATEGORIES:
-        if k in s:
-            return k
-    return "その他"
+    if s in _CAT_ORDER:  # 登録データはほぼ正規のカテゴリ名そのもの（走査不要）
+        return s
+    hits = _CAT_RE.findall(s)
+    if not hits:
+        return "その他"
+    return min(hits, key=_CAT_ORDER.__getitem__)
+
+_DATE_RE = re.compile(r"(\d{4})[\/\-\.\年](\d{1,2})[\/\-\.\月](\d{1,2})")
 
 def iso_to_date(s: Any) -> Optional[date]:
     if not s:
         return None
-    try:
-        return date.fromisoformat(str(s).split("T")[0])
-    except Exception:
-        m = re.search(r"(\d{4})[\/\-\.\年](\d{1,2})[\/\-\.\月](\d{1,2})", str(s))
-        if m:
+    ss = str(s)
+    # ISO（YYYY-MM-DD / 日時付き）は形で判定して直接 fromisoformat（split や例外を経由しない）
+    if len(ss) >= 10 and ss[4] == "-" and ss[7] == "-":
+        try:
+            return date.fromisoformat(ss[:10])
+        except ValueError:
+            pass
+    m = _DATE_RE.search(ss)
+    if m:
+        try:
             return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
-    return None
+        except ValueError:  # 2024/2/30 のような存在しない日付
+            return None
+    # 20240105 など、上の2つに当てはまらないが fromisoformat なら読める形
+    try:
+        return date.fromisoformat(ss.split("T")[0])
+    except ValueError:
+        return None
 
-amounts: Dict[str, float] = {k: 0.0 for k in CATEGORIES}
-expired_count = 0
+def aggregate_stocks(
+    stocks: List[Dict[str, Any]], today: date
+) -> Tuple[Dict[str, float], int, Dict[str, List[int]], float]:
+    """
+    在庫の集計（ホーム/点検/充足率/一覧で共通）。
+    行ごとの Python ループではなく DataFrame の列演算 + groupby で数量を合算する。
+    戻り値: (カテゴリ別数量, 期限切れ件数, カテゴリ別の行id, トイレ基数)
+    行そのものは持たない：st.cache_data は戻り値を毎回 unpickle するので、
+    行を入れると全行を二重に復元することになる。行は load_stocks から id で引く。
+    """
+    amounts: Dict[str, float] = {k: 0.0 for k in CATEGORIES}
+    cat_ids: Dict[str, List[int]] = {k: [] for k in CATEGORIES}
+    if not stocks:
+        return amounts, 0, cat_ids, 0.0
 
-for s in stocks:
-    cat = get_cat_key(s.get("category"))
-    kind = str(s.get("item_kind", "stock") or "stock")
-    qty = float(s.get("qty", 0) or 0)
-    unit = str(s.get("unit") or "").strip()
+    df = pd.DataFrame(stocks)
+    # カテゴリ判定は「異なる文字列ごとに1回」だけ行い、列全体へは map で展開
+    raw_cat = df["category"].fillna("").astype(str)
+    df["cat_key"] = raw_cat.map({c: get_cat_key(c) for c in raw_cat.unique()})
+    qty = df["qty"].fillna(0.0).astype(float)  # init_db で数値に正規化済み
 
     # 飲料水：設備能力(capacity)は合算しない（在庫のみ）
-    if kind == "capacity" and cat == "水・飲料":
-        continue
-
-    if cat == "トイレ・衛生":
-        if unit in ["回", "枚", "袋", ""]:
-            amounts[cat] += qty
-    else:
-        amounts[cat] += qty
-
-    d = iso_to_date(s.get("due_date"))
-    if d and d < today:
-        expired_count += 1
+    water_capacity = (df["cat_key"] == "水・飲料") & (df["item_kind"].fillna("stock") == "capacity")
+    # トイレ：回/枚/袋（単位なし含む）のみ回数として合算
+    toilet_other_unit = (df["cat_key"] == "トイレ・衛生") & ~(
+        df["unit"].fillna("").astype(str).str.strip().isin(["回", "枚", "袋", ""])
+    )
+    counted = ~(water_capacity | toilet_other_unit)
+    for k, v in qty[counted].groupby(df.loc[counted, "cat_key"]).sum().items():
+        amounts[k] = float(v)
+
+    # 点検 6-5 のトイレ基数（仮設/組立の数量。単位は問わない）
+    toilet_units = float(qty[
+        (df["cat_key"] == "トイレ・衛生")
+        & df["subtype"].fillna("").astype(str).isin(TOILET_UNIT_SUBTYPES)
+    ].sum())
+
+    for k, idx in df.groupby("cat_key").indices.items():
+        cat_ids[k] = df["id"].iloc[idx].tolist()
+
+    # 期限切れ：日付部分を列ごと抽出して一括変換（読めない/不正な日付は NaT → 比較は False）
+    ymd = df["due_date"].fillna("").astype(str).str.extract(_DATE_RE).astype(float)
+    ymd.columns = ["year", "month", "day"]
+    due = pd.to_datetime(ymd, errors="coerce")
+    expired_count = int(((due < pd.Timestamp(today)) & ~water_capacity).sum())
+
+    return amounts, expired_count, cat_ids, toilet_units
+
+# 再実行（ボタン/スライダー操作）のたびに SQL + 集計をやり直さない。
+# キーは db.get_stocks_version()（stocks が変わるとトリガーで増える）なので、
+# どこから書き換えても次の再実行で作り直される。古い版は max_entries で押し出す。
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_stocks(version: int) -> List[Dict[str, Any]]:
+    return db.get_all_stocks() or []
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_stock_summary(version: int, today_iso: str) -> Tuple[Dict[str, float], int, Dict[str, List[int]], float]:
+    return aggregate_stocks(load_stocks(version), date.fromisoformat(today_iso))
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def stocks_csv_bytes(version: int, _stocks: List[Dict[str, Any]]) -> bytes:
+    """
+    CSVバックアップ（Excel向け BOM付き）。
+    全行をハッシュしてキーにすると生成と同程度のコストがかかるため、在庫バージョンだけをキーにする。
+    行は csv.writer で1回だけ走査して書く（DataFrame を経由しない）。
+    """
+    buf = io.StringIO()
+    if _stocks:
+        w = csv.DictWriter(buf, fieldnames=list(_stocks[0]), extrasaction="ignore", lineterminator="\n")
+        w.writeheader()
+        w.writerows(_stocks)
+    return buf.getvalue().encode("utf-8-sig")
+
+# 行そのもの（load_stocks）は一覧/CSV を出すページでだけ読む。他のページは集計値だけで足りる。
+stocks_version = db.get_stocks_version()
+amounts, expired_count, stock_ids_by_cat, toilet_units = load_stock_summary(stocks_version, today.isoformat())
+# 充足率（0〜1）は目標ごとに1回だけ計算して各ページで使い回す
+fill_rates = {k: min(amounts[k] / (float(t) or 1.0), 1.0) for k, t in TARGETS.items()}
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def stock_table(version: int, cat: str, today_iso: str, _rows: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    登録済みリストの表示用 DataFrame（カテゴリ単位、在庫バージョンをキーにキャッシュ）。
+    期限切れ/30日以内は「状態」列で示す（Styler で行ごとに色付けするより軽い）。
+    """
+    df = pd.DataFrame(_rows).reindex(columns=list(STOCK_TABLE_COLS) + ["item_kind"])
+    df["due_type"] = df["due_type"].map(lambda v: DUE_LABEL.get(v, v))
+
+    ymd = df["due_date"].fillna("").astype(str).str.extract(_DATE_RE).astype(float)
+    ymd.columns = ["year", "month", "day"]
+    due = pd.to_datetime(ymd, errors="coerce")
+    t = pd.Timestamp(date.fromisoformat(today_iso))
+    dated = due.notna() & (df["item_kind"] != "capacity")
+    status = pd.Series("", index=df.index)
+    status[dated & (due < t + pd.Timedelta(days=30))] = "🟡 30日以内"
+    status[dated & (due < t)] = "🔴 期限切れ"
+
+    df = df.drop(columns="item_kind").rename(columns=STOCK_TABLE_COLS)
+    df.insert(0, "状態", status)
+    return df
+
+def stock_label(s: Dict[str, Any]) -> str:
+    qty = s.get("qty") or 0
+    label = f"{s.get('name','')} (×{int(qty) if float(qty).is_integer() else qty})"
+    due = s.get("due_date", "")
+    if due:
+        label += f" / {due}"
+    return label
 
 # =========================================================
 # Gemini helpers
 # =========================================================
 def _clean_json_text(text: str) -> str:
     t = (text or "").strip()
-    # code fence除去
-    t = re.sub(r"^```(?:json)?\s*", "", t, flags=re.I)
-    t = re.sub(r"\s*```$", "", t)
-    return t.strip()
+    # code fence除去（```json / ``` の前後だけを見る。全体を走査する置換はしない）
+    if t.startswith("```"):
+        t = t[3:]
+        if t[:4].lower() == "json":
+            t = t[4:]
+    return t.removesuffix("```").strip()
 
 def _extract_json_array(text: str) -> List[Dict[str, Any]]:
     t = _clean_json_text(text)
@@ -380,9 +570,29 @@ def _extract_json_array(text: str) -> List[Dict[str, Any]]:
             if isinstance(obj, list):
                 return obj
         except Exception:
-            return []
+            # 最後に、途中で切れた配列から閉じている要素だけを拾う
+            return _salvage_json_objects(t)
     return []
 
+_JSON_DECODER = json.JSONDecoder()
+
+def _salvage_json_objects(text: str) -> List[Dict[str, Any]]:
+    """
+    max_output_tokens で打ち切られた `[{...}, {...}, {"na` のような出力から、
+    閉じている {...} を先頭から順に1回の走査で取り出す（壊れた所で止める）。
+    """
+    out: List[Dict[str, Any]] = []
+    i = text.find("{")
+    while i != -1:
+        try:
+            obj, end = _JSON_DECODER.raw_decode(text, i)
+        except ValueError:
+            break
+        if isinstance(obj, dict):
+            out.append(obj)
+        i = text.find("{", end)
+    return out
+
 def _normalize_date_str(s: str) -> str:
     s = (s or "").strip()
     if not s:
@@ -390,6 +600,16 @@ def _normalize_date_str(s: str) -> str:
     d = iso_to_date(s)
     return d.isoformat() if d else ""
 
+# due_type の表記ゆれ（AIが日本語ラベルで返すことがある）→ 正規値。1回の辞書引きで決める
+_DUE_ALIAS: Dict[str, str] = {
+    **{k: k for k in DUE_LABEL},
+    **{v: k for k, v in DUE_LABEL.items()},
+    "消費期限": "expiry",
+    "期限": "expiry",
+    "点検": "inspection",
+    "なし": "none",
+}
+
 def _normalize_ai_item(it: Dict[str, Any], category: str) -> Dict[str, Any]:
     name = str(it.get("name") or it.get("item") or "").strip()
     if not name:
@@ -407,9 +627,7 @@ def _normalize_ai_item(it: Dict[str, Any], category: str) -> Dict[str, Any]:
     subtype = str(it.get("subtype") or "").strip()
     memo = str(it.get("memo") or "").strip()
 
-    due_type = str(it.get("due_type") or "none").strip().lower()
-    if due_type not in ("expiry", "inspection", "none"):
-        due_type = "none"
+    due_type = _DUE_ALIAS.get(str(it.get("due_type") or "none").strip().lower(), "none")
 
     due_date = _normalize_date_str(str(it.get("due_date") or ""))
 
@@ -434,21 +652,23 @@ def _normalize_ai_item(it: Dict[str, Any], category: str) -> Dict[str, Any]:
         "memo": memo,
     }
 
-def _preprocess_image(uploaded_file, max_side: int = 1280, quality: int = 85) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+def _preprocess_image(raw: bytes, max_side: int = 1280, quality: int = 85) -> Tuple[Dict[str, Any], Dict[str, Any]]:
     """iPhone写真が重すぎて遅い/タイムアウトの原因になるので縮小して送る"""
-    raw = uploaded_file.getvalue()
     orig_kb = int(len(raw) / 1024)
 
+    from PIL import Image
+
     img = Image.open(io.BytesIO(raw))
-    img = img.convert("RGB")
     w, h = img.size
 
-    scale = min(1.0, float(max_side) / float(max(w, h)))
-    if scale < 1.0:
-        nw, nh = max(1, int(w * scale)), max(1, int(h * scale))
-        img = img.resize((nw, nh), Image.LANCZOS)
-    else:
-        nw, nh = w, h
+    # 縮小してから RGB 化する（変換コストは画素数に比例）。
+    # JPEG は draft でデコード時に 1/2〜1/8 へ落とせるので、フル解像度を展開しない。
+    img.draft("RGB", (max_side, max_side))
+    if img.mode not in ("RGB", "RGBA", "L"):
+        img = img.convert("RGB")
+    img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+    img = img.convert("RGB")
+    nw, nh = img.size
 
     buf = io.BytesIO()
     img.save(buf, format="JPEG", quality=quality, optimize=True)
@@ -459,17 +679,8 @@ def _preprocess_image(uploaded_file, max_side: int = 1280, quality: int = 85) ->
     info = {"orig_kb": orig_kb, "new_kb": new_kb, "orig_px": f"{w}x{h}", "new_px": f"{nw}x{nh}"}
     return part, info
 
-def gemini_extract(uploaded_file, cat: str, model_name: str, timeout_s: int) -> Tuple[List[Dict[str, Any]], str, Dict[str, Any]]:
-    """Gemini呼び出し：ハング回避(REST + timeout) + JSON固定"""
-    if genai is None:
-        return [], "google-generativeai がインストールされていません。", {}
-    if not EFFECTIVE_GEMINI_KEY or not EFFECTIVE_GEMINI_KEY.startswith("AIza"):
-        return [], "APIキーが未設定です。環境変数 GEMINI_API_KEY またはサイドバーで設定してください。", {}
-
-    # 画像を軽量化
-    image_part, info = _preprocess_image(uploaded_file)
-
-    prompt = f"""
+# プロンプト本体は固定。呼び出しごとに変わるのはカテゴリのみ（str.format で差し込む）
+GEMINI_PROMPT_TMPL = """
 あなたは「防災備蓄品の登録AI」です。
 カテゴリ: {cat}
 
@@ -495,41 +706,138 @@ def gemini_extract(uploaded_file, cat: str, model_name: str, timeout_s: int) ->
 - due_type が none の場合 due_date は空文字にする。
 """
 
-    # generation_config：JSON固定（使えないSDK版でも落ちないようフォールバック）
+@st.cache_resource(show_spinner=False)
+def get_gemini_model(model_name: str, gemini_key: str):
+    """
+    GenerativeModel を再実行をまたいで使い回す。
+    gemini_key はキャッシュキー用（キーが変わったら作り直し、古いクライアントを掴まない）。
+    """
+    return ensure_gemini().GenerativeModel(model_name=model_name)
+
+@st.cache_resource(show_spinner=False)
+def get_generation_config():
+    """generation_config：JSON固定（使えないSDK版でも落ちないようフォールバック）。毎回は作らない。"""
+    genai = ensure_gemini()
     try:
-        gconf = genai.GenerationConfig(
+        return genai.GenerationConfig(
             temperature=0.2,
             max_output_tokens=1024,
             response_mime_type="application/json",
         )
     except Exception:
-        gconf = genai.GenerationConfig(
+        return genai.GenerationConfig(
             temperature=0.2,
             max_output_tokens=1024,
         )
 
+# 429（レート制限）/ 一時的な 5xx だけ再試行する。タイムアウトや 4xx はそのまま失敗させる。
+GEMINI_RETRY_ATTEMPTS = 3
+
+def _is_rate_or_server_error(e: BaseException) -> bool:
+    return isinstance(e, _retryable_gemini_errors()) or getattr(e, "code", None) in (429, 500, 503)
+
+def _generate_with_retry(model, contents, **kwargs):
+    """generate_content を指数バックオフ（+ジッタ）付きで呼ぶ。"""
+    for attempt in range(GEMINI_RETRY_ATTEMPTS):
+        try:
+            return model.generate_content(contents, **kwargs)
+        except Exception as e:
+            if not _is_rate_or_server_error(e) or attempt + 1 >= GEMINI_RETRY_ATTEMPTS:
+                raise
+            time.sleep(min(2 ** attempt, 8) + random.uniform(0, 0.5))
+
+class GeminiNoItems(Exception):
+    """応答はあったが品目を1件も取り出せなかった（空応答/壊れたJSON）。キャッシュさせないため例外にする。"""
+
+    def __init__(self, raw: str):
+        super().__init__(f"品目を抽出できませんでした（AI出力: {raw[:500] or '空'}）")
+        self.raw = raw
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _gemini_extract_cached(
+    img_sha256: str, cat: str, model_name: str, _img_bytes: bytes, _timeout_s: int
+) -> Tuple[List[Dict[str, Any]], str, Dict[str, Any]]:
+    """
+    画像の SHA-256 + カテゴリ + モデルをキーに解析結果をキャッシュする。
+    同じ写真の再アップロード/再押下では Gemini を呼ばない。
+    （_ 始まりの引数はキーに含めない：画像本体は digest で代表させる）
+    失敗は例外で返す（st.cache_data は例外をキャッシュしないので再試行できる）。
+    品目が0件の応答も GeminiNoItems で失敗扱いにし、成功した結果だけをキャッシュする。
+    """
+    # 画像を軽量化
+    image_part, info = _preprocess_image(_img_bytes)
+
+    prompt = GEMINI_PROMPT_TMPL.format(cat=cat)
+
+    gconf = get_generation_config()
+    model = get_gemini_model(model_name, EFFECTIVE_GEMINI_KEY)
+
+    # ✅ ここが「無限グルグル」回避の本丸：timeout付ける
+    # request_optionsの使用例は公式フォーラムでも言及あり
+    result = _generate_with_retry(
+        model,
+        [prompt, image_part],
+        generation_config=gconf,
+        request_options={"timeout": int(_timeout_s)},
+    )
+    raw = getattr(result, "text", "") or ""
+    items = _extract_json_array(raw)
+
+    norm: List[Dict[str, Any]] = []
+    for x in items:
+        if isinstance(x, dict):
+            norm.append(_normalize_ai_item(x, cat))
+    if not norm:
+        raise GeminiNoItems(raw)
+
+    return norm, raw, info
+
+def gemini_extract(uploaded_file, cat: str, model_name: str, timeout_s: int) -> Tuple[List[Dict[str, Any]], str, Dict[str, Any]]:
+    """
+    Gemini呼び出し：ハング回避(REST + timeout) + JSON固定
+    失敗時の info は {"retryable": bool}。押し直せば通りうる失敗（空応答/429/5xx/タイムアウト/接続断）だけ True。
+    SDK・APIキー未設定や画像が開けない場合は False（何度呼んでも同じ）。
+    """
+    if ensure_gemini() is None:
+        return [], "google-generativeai がインストールされていません。", {}
+    if not EFFECTIVE_GEMINI_KEY or not EFFECTIVE_GEMINI_KEY.startswith("AIza"):
+        return [], "APIキーが未設定です。環境変数 GEMINI_API_KEY またはサイドバーで設定してください。", {}
+
     try:
-        model = genai.GenerativeModel(model_name=model_name)
-
-        # ✅ ここが「無限グルグル」回避の本丸：timeout付ける
-        # request_optionsの使用例は公式フォーラムでも言及あり
-        result = model.generate_content(
-            [prompt, image_part],
-            generation_config=gconf,
-            request_options={"timeout": int(timeout_s)},
+        img_bytes = uploaded_file.getvalue()
+        return _gemini_extract_cached(
+            hashlib.sha256(img_bytes).hexdigest(), cat, model_name, img_bytes, int(timeout_s)
         )
-        raw = getattr(result, "text", "") or ""
-        items = _extract_json_array(raw)
+    except Exception as e:
+        retryable = (
+            isinstance(e, (GeminiNoItems,) + _transient_network_errors()) or _is_rate_or_server_error(e)
+        )
+        return [], f"{type(e).__name__}: {e}", {"retryable": retryable}
 
-        norm: List[Dict[str, Any]] = []
-        for x in items:
-            if isinstance(x, dict):
-                norm.append(_normalize_ai_item(x, cat))
+# 同時に投げる画像数（レート制限に当たりにくい程度に抑える）
+GEMINI_MAX_PARALLEL = 4
 
-        return norm, raw, info
+def gemini_extract_many(
+    uploaded_files: List[Any], cat: str, model_name: str, timeout_s: int
+) -> List[Tuple[List[Dict[str, Any]], str, Dict[str, Any]]]:
+    """
+    複数画像をスレッドで並列に解析する（待ち時間の大半はAPI応答なので重ねられる）。
+    REST transport は同期APIのみのため asyncio ではなくスレッドを使う。結果は入力順。
+    """
+    files = list(uploaded_files or [])
+    if len(files) <= 1:
+        return [gemini_extract(f, cat, model_name, timeout_s) for f in files]
 
-    except Exception as e:
-        return [], f"{type(e).__name__}: {e}", info
+    ensure_gemini()  # configure はワーカーより先に1回だけ
+    ctx = get_script_run_ctx() if get_script_run_ctx else None
+
+    def _run(f):
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        return gemini_extract(f, cat, model_name, timeout_s)
+
+    with ThreadPoolExecutor(max_workers=min(GEMINI_MAX_PARALLEL, len(files))) as ex:
+        return list(ex.map(_run, files))
 
 # =========================================================
 # Pages
@@ -540,6 +848,124 @@ def back_home(sfx: str):
         st.session_state.pending_items = []
         navigate_to("home")
 
+# st.fragment（1.37+）/ st.experimental_fragment（1.33+）があれば、その範囲の操作は部分再実行で済ませる。
+# 無い版では普通の関数として呼ばれ、従来どおり全体が再実行される。
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
+
+@_fragment
+def render_cart(cat: str) -> None:
+    """カート（未登録）の一括操作と個別編集。入力のたびにページ全体を再実行しない。"""
+    pending: List[Dict[str, Any]] = st.session_state.pending_items or []
+    if not pending:
+        st.info("カートは空です（AI登録タブで解析するとここに入ります）")
+    else:
+        st.warning(f"未登録: {len(pending)}件（ここで修正してからDB登録できます）")
+
+        # まとめて操作
+        col_a, col_b = st.columns(2)
+        with col_a:
+            if st.button("🧹 カート全消去", type="secondary", use_container_width=True):
+                st.session_state.pending_items = []
+                st.rerun()
+        with col_b:
+            if st.button("✅ この内容でDB登録", type="primary", use_container_width=True):
+                try:
+                    payload = []
+                    for it in st.session_state.pending_items:
+                        payload.append({
+                            "name": it.get("name"),
+                            "qty": it.get("qty"),
+                            "unit": it.get("unit", ""),
+                            "category": it.get("category", cat),
+                            "item_kind": it.get("item_kind", "stock"),
+                            "subtype": it.get("subtype", ""),
+                            "due_type": it.get("due_type", "none"),
+                            "due_date": it.get("due_date", ""),
+                            "memo": it.get("memo", ""),
+                        })
+                    db.bulk_upsert(payload)
+                    st.session_state.pending_items = []
+                    st.success("DB登録しました！")
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"DB登録エラー: {type(e).__name__}: {e}")
+
+        st.markdown("---")
+
+        # 個別編集
+        for idx, it in enumerate(list(st.session_state.pending_items)):
+            tmp_id = it.get("_tmp_id", str(idx))
+            title = f"{it.get('name','(no name)')}  ×{it.get('qty',1)}"
+            with st.expander(title, expanded=False):
+                # 削除
+                if st.button("🗑️ この行を削除", key=f"del_pending_{tmp_id}", type="secondary", use_container_width=True):
+                    st.session_state.pending_items = [x for x in st.session_state.pending_items if x.get("_tmp_id") != tmp_id]
+                    st.rerun()
+
+                it["name"] = st.text_input("品名", value=str(it.get("name","")), key=f"name_{tmp_id}")
+                it["qty"] = st.number_input("数量", value=float(it.get("qty", 1) or 1), min_value=0.0, step=1.0, key=f"qty_{tmp_id}")
+                it["unit"] = st.text_input("単位", value=str(it.get("unit","")), key=f"unit_{tmp_id}")
+
+                # トイレ subtype
+                if cat == "トイレ・衛生":
+                    cur = str(it.get("subtype","") or "")
+                    if cur not in TOILET_SUBTYPES:
+                        cur = "その他"
+                    it["subtype"] = st.selectbox("種別", TOILET_SUBTYPES, index=TOILET_SUBTYPES.index(cur), key=f"subtype_{tmp_id}")
+                else:
+                    it["subtype"] = ""
+
+                # due_type / due_date
+                due_type_cur = str(it.get("due_type","none") or "none").lower()
+                if due_type_cur not in ["expiry", "inspection", "none"]:
+                    due_type_cur = "none"
+                due_type_label_list = ["none", "expiry", "inspection"]
+                due_type_label_map = {"none": "期限なし", "expiry": "賞味期限", "inspection": "点検日"}
+                it["due_type"] = st.selectbox(
+                    "期限種別",
+                    due_type_label_list,
+                    index=due_type_label_list.index(due_type_cur),
+                    format_func=lambda x: due_type_label_map.get(x, x),
+                    key=f"due_type_{tmp_id}",
+                )
+
+                if it["due_type"] == "none":
+                    it["due_date"] = ""
+                    st.caption("期限なし（due_date は空になります）")
+                else:
+                    # 初期値
+                    date_key = f"due_date_{tmp_id}"
+                    if date_key not in st.session_state:
+                        d0 = iso_to_date(it.get("due_date")) or today
+                        st.session_state[date_key] = d0
+
+                    # クイックボタン（+1/+3/+5年）
+                    qc1, qc2, qc3 = st.columns(3)
+                    base = today
+                    with qc1:
+                        if st.button("+1年", key=f"q1_{tmp_id}", use_container_width=True):
+                            nd = date(base.year + 1, base.month, min(base.day, 28) if base.month == 2 else base.day)
+                            st.session_state[date_key] = nd
+                            it["due_date"] = nd.isoformat()
+                            st.rerun()
+                    with qc2:
+                        if st.button("+3年", key=f"q3_{tmp_id}", use_container_width=True):
+                            nd = date(base.year + 3, base.month, min(base.day, 28) if base.month == 2 else base.day)
+                            st.session_state[date_key] = nd
+                            it["due_date"] = nd.isoformat()
+                            st.rerun()
+                    with qc3:
+                        if st.button("+5年", key=f"q5_{tmp_id}", use_container_width=True):
+                            nd = date(base.year + 5, base.month, min(base.day, 28) if base.month == 2 else base.day)
+                            st.session_state[date_key] = nd
+                            it["due_date"] = nd.isoformat()
+                            st.rerun()
+
+                    dval = st.date_input("期限日", key=date_key)
+                    it["due_date"] = dval.isoformat()
+
+                it["memo"] = st.text_area("メモ", value=str(it.get("memo","")), key=f"memo_{tmp_id}")
+
 # -----------------------
 # Home
 # -----------------------
@@ -577,12 +1003,7 @@ elif st.session_state.current_page == "inspection":
 
     # 6-5（簡易版：携帯トイレ回数 + 基数）
     p_uses = amounts["トイレ・衛生"]
-    units = float(f_toilets) + sum(
-        float(s.get("qty", 0) or 0)
-        for s in stocks
-        if get_cat_key(s.get("category")) == "トイレ・衛生"
-        and str(s.get("subtype") or "") in ["仮設トイレ", "組立トイレ"]
-    )
+    units = float(f_toilets) + toilet_units
     need_uses = max(t_pop * 5 * 3, t_pop * 5 * t_days)  # 最低3日分
     need_units = (t_pop + 49) // 50 if t_days <= 2 else (t_pop + 19) // 20
 
@@ -602,7 +1023,7 @@ elif st.session_state.current_page == "inspection":
         unsafe_allow_html=True,
     )
 
-    ok_71 = amounts["水・飲料"] >= TARGETS["水・飲料"]
+    ok_71 = fill_rates["水・飲料"] >= 1.0
     st.markdown(
         f"""
 <div class="card {'card-ok' if ok_71 else 'card-ng'}">
@@ -623,9 +1044,7 @@ elif st.session_state.current_page == "dashboard":
     back_home("dash")
     st.markdown("## 📊 充足率")
 
-    for k in ["水・飲料", "主食類", "トイレ・衛生"]:
-        target = float(TARGETS.get(k) or 0) or 1.0
-        pct = min(float(amounts.get(k) or 0) / target, 1.0)
+    for k, pct in fill_rates.items():
         st.write(f"**{k}**")
         st.progress(pct)
         st.caption(f"現在: {int(amounts[k]):,} / 目標: {int(TARGETS[k]):,}（{int(pct*100)}%）")
@@ -661,21 +1080,23 @@ elif st.session_state.current_page == "inventory":
             st.session_state.pending_items = []
             st.rerun()
 
-        tab_ai, tab_cart, tab_list = st.tabs(["📸 AI登録", "🛒 カート(未登録)", "📝 登録済みリスト"])
+        # st.tabs は非表示タブの中身まで毎回実行するため、選択中の画面だけを描画する
+        INV_VIEWS = ["📸 AI登録", "🛒 カート(未登録)", "📝 登録済みリスト"]
+        inv_view = st.radio("表示", INV_VIEWS, horizontal=True, key="inv_view", label_visibility="collapsed")
 
         # ---------- AI登録 ----------
-        with tab_ai:
+        if inv_view == INV_VIEWS[0]:
             st.caption(f"モデル: **{selected_model}** / タイムアウト: **{timeout_sec}s** / transport: **REST**")
 
             # 接続テスト（軽いテキスト生成）
             if st.button("🧪 AI接続テスト（10秒）", type="secondary", use_container_width=True):
-                if genai is None:
+                if ensure_gemini() is None:
                     st.error("google-generativeai がありません。requirements を確認してください。")
                 elif not (EFFECTIVE_GEMINI_KEY and EFFECTIVE_GEMINI_KEY.startswith("AIza")):
                     st.error("APIキーが未設定です。")
                 else:
                     try:
-                        m = genai.GenerativeModel(model_name=selected_model)
+                        m = get_gemini_model(selected_model, EFFECTIVE_GEMINI_KEY)
                         r = m.generate_content(
                             "Say OK",
                             request_options={"timeout": 10},
@@ -684,175 +1105,122 @@ elif st.session_state.current_page == "inventory":
                     except Exception as e:
                         st.error(f"接続テスト失敗: {type(e).__name__}: {e}")
 
-            img_file = st.camera_input("撮影（iPhone対応）")
-            if not img_file:
-                img_file = st.file_uploader("または画像アップロード", type=["jpg", "jpeg", "png"])
-
-            if img_file is not None:
-                st.image(img_file, caption="入力画像（プレビュー）", use_container_width=True)
-
-            if img_file is not None and st.button("解析開始（AI）", type="primary", use_container_width=True):
-                with st.spinner("AI解析中...（終わらない場合はタイムアウトで止まります）"):
-                    items, raw, info = gemini_extract(img_file, cat, selected_model, timeout_sec)
-                    st.session_state.ai_last_raw = raw
-
-                if not items:
+            # 直前の解析結果（rerun をまたいで1回だけ表示）
+            notice = st.session_state.ai_notice
+            st.session_state.ai_notice = None
+            if notice:
+                if notice["added"]:
+                    st.success(f"AI抽出: {notice['added']}件 → カートに追加しました")
+                    if notice["failed"]:
+                        st.warning(
+                            f"{len(notice['failed'])}枚の画像から品目を読み取れませんでした（カートには入っていません）\n\n"
+                            + "\n".join(f"- {n}: {raw or '（応答なし）'}" for n, raw in notice["failed"])
+                        )
+                else:
                     st.error("AI解析に失敗しました（タイムアウト/モデル名/ネットワーク等）")
-                    st.caption(f"詳細: {raw}")
+                    for n, raw in notice["failed"]:
+                        st.caption(f"{n}: {raw or '（応答なし）'}")
                     with st.expander("デバッグ（AI生出力）"):
                         st.code(st.session_state.ai_last_raw or "", language="text")
                     st.info("対策：①モデルをFlash-Liteにする ②画像が重い場合は撮り直し ③ネットワーク確認 ④REST transportは適用済み")
-                else:
-                    # カートへ追加（UUIDで識別）
-                    for it in items:
-                        it2 = dict(it)
-                        it2["category"] = cat
-                        it2["item_kind"] = "stock"
-                        it2["_tmp_id"] = str(uuid.uuid4())
-                        st.session_state.pending_items.append(it2)
-
-                    st.success(f"AI抽出: {len(items)}件 → カートに追加しました")
-                    st.caption(f"画像軽量化: {info.get('orig_px')} {info.get('orig_kb')}KB → {info.get('new_px')} {info.get('new_kb')}KB")
-                    st.rerun()
+                for n, info in notice["info"]:
+                    st.caption(f"{n} 画像軽量化: {info.get('orig_px')} {info.get('orig_kb')}KB → {info.get('new_px')} {info.get('new_kb')}KB")
 
-        # ---------- カート（未登録） ----------
-        with tab_cart:
-            pending: List[Dict[str, Any]] = st.session_state.pending_items or []
-            if not pending:
-                st.info("カートは空です（AI登録タブで解析するとここに入ります）")
+            img_file = st.camera_input("撮影（iPhone対応）")
+            if img_file:
+                img_files = [img_file]
             else:
-                st.warning(f"未登録: {len(pending)}件（ここで修正してからDB登録できます）")
-
-                # まとめて操作
-                col_a, col_b = st.columns(2)
-                with col_a:
-                    if st.button("🧹 カート全消去", type="secondary", use_container_width=True):
-                        st.session_state.pending_items = []
-                        st.rerun()
-                with col_b:
-                    if st.button("✅ この内容でDB登録", type="primary", use_container_width=True):
-                        try:
-                            payload = []
-                            for it in st.session_state.pending_items:
-                                payload.append({
-                                    "name": it.get("name"),
-                                    "qty": it.get("qty"),
-                                    "unit": it.get("unit", ""),
-                                    "category": it.get("category", cat),
-                                    "item_kind": it.get("item_kind", "stock"),
-                                    "subtype": it.get("subtype", ""),
-                                    "due_type": it.get("due_type", "none"),
-                                    "due_date": it.get("due_date", ""),
-                                    "memo": it.get("memo", ""),
-                                })
-                            db.bulk_upsert(payload)
-                            st.session_state.pending_items = []
-                            st.success("DB登録しました！")
-                            st.rerun()
-                        except Exception as e:
-                            st.error(f"DB登録エラー: {type(e).__name__}: {e}")
-
-                st.markdown("---")
-
-                # 個別編集
-                for idx, it in enumerate(list(st.session_state.pending_items)):
-                    tmp_id = it.get("_tmp_id", str(idx))
-                    title = f"{it.get('name','(no name)')}  ×{it.get('qty',1)}"
-                    with st.expander(title, expanded=False):
-                        # 削除
-                        if st.button("🗑️ この行を削除", key=f"del_pending_{tmp_id}", type="secondary", use_container_width=True):
-                            st.session_state.pending_items = [x for x in st.session_state.pending_items if x.get("_tmp_id") != tmp_id]
-                            st.rerun()
-
-                        it["name"] = st.text_input("品名", value=str(it.get("name","")), key=f"name_{tmp_id}")
-                        it["qty"] = st.number_input("数量", value=float(it.get("qty", 1) or 1), min_value=0.0, step=1.0, key=f"qty_{tmp_id}")
-                        it["unit"] = st.text_input("単位", value=str(it.get("unit","")), key=f"unit_{tmp_id}")
-
-                        # トイレ subtype
-                        if cat == "トイレ・衛生":
-                            cur = str(it.get("subtype","") or "")
-                            if cur not in TOILET_SUBTYPES:
-                                cur = "その他"
-                            it["subtype"] = st.selectbox("種別", TOILET_SUBTYPES, index=TOILET_SUBTYPES.index(cur), key=f"subtype_{tmp_id}")
-                        else:
-                            it["subtype"] = ""
-
-                        # due_type / due_date
-                        due_type_cur = str(it.get("due_type","none") or "none").lower()
-                        if due_type_cur not in ["expiry", "inspection", "none"]:
-                            due_type_cur = "none"
-                        due_type_label_list = ["none", "expiry", "inspection"]
-                        due_type_label_map = {"none": "期限なし", "expiry": "賞味期限", "inspection": "点検日"}
-                        it["due_type"] = st.selectbox(
-                            "期限種別",
-                            due_type_label_list,
-                            index=due_type_label_list.index(due_type_cur),
-                            format_func=lambda x: due_type_label_map.get(x, x),
-                            key=f"due_type_{tmp_id}",
-                        )
+                img_files = st.file_uploader(
+                    "または画像アップロード（複数可）", type=["jpg", "jpeg", "png"], accept_multiple_files=True
+                ) or []
+
+            if img_files:
+                st.image(
+                    img_files,
+                    caption=[getattr(f, "name", "") or "入力画像（プレビュー）" for f in img_files],
+                    use_container_width=True,
+                )
+
+            # 前回失敗した画像がまだアップロード中なら、それだけを再解析できる
+            failed_shas = {f["sha256"] for f in st.session_state.ai_failed}
+            retry_files = [
+                f for f in img_files if hashlib.sha256(f.getvalue()).hexdigest() in failed_shas
+            ] if failed_shas else []
+
+            targets: List[Any] = []
+            if img_files and st.button("解析開始（AI）", type="primary", use_container_width=True):
+                targets = img_files
+            if retry_files and st.button(
+                f"🔁 失敗した画像だけ再解析（{len(retry_files)}枚）", type="secondary", use_container_width=True
+            ):
+                targets = retry_files
+
+            if targets:
+                with st.spinner("AI解析中...（終わらない場合はタイムアウトで止まります）"):
+                    results = gemini_extract_many(targets, cat, selected_model, timeout_sec)
+                    st.session_state.ai_last_raw = "\n\n".join(raw for _, raw, _ in results)
+
+                names = [getattr(f, "name", "") or f"画像{i + 1}" for i, f in enumerate(targets)]
+                # 品目が取れなかった画像（エラー/タイムアウト/空応答）は画像ごとに理由を残す
+                failed = [(n, raw) for n, (its, raw, _) in zip(names, results) if not its]
+                # 再解析の対象は押し直せば通りうる失敗だけ（キー未設定や開けない画像は何度やっても同じ）
+                st.session_state.ai_failed = [
+                    {"name": n, "sha256": hashlib.sha256(f.getvalue()).hexdigest()}
+                    for n, f, (_, _, info) in zip(names, targets, results) if info.get("retryable")
+                ]
+
+                items = [it for its, _, _ in results for it in its]
+                # カートへ追加（セッション内の連番で識別。ウィジェットkeyに使うので使い回さない）
+                seq = st.session_state.cart_seq
+                for n, it in enumerate(items, start=seq + 1):
+                    it2 = dict(it)
+                    it2["category"] = cat
+                    it2["item_kind"] = "stock"
+                    it2["_tmp_id"] = f"c{n}"
+                    st.session_state.pending_items.append(it2)
+                st.session_state.cart_seq = seq + len(items)
+
+                # 結果は rerun 後に表示する（再解析ボタンの表示も最新の失敗一覧に合わせるため、失敗時も rerun）
+                st.session_state.ai_notice = {
+                    "added": len(items),
+                    "failed": failed,
+                    "info": [(n, info) for n, (_, _, info) in zip(names, results) if "new_px" in info],
+                }
+                st.rerun()
 
-                        if it["due_type"] == "none":
-                            it["due_date"] = ""
-                            st.caption("期限なし（due_date は空になります）")
-                        else:
-                            # 初期値
-                            date_key = f"due_date_{tmp_id}"
-                            if date_key not in st.session_state:
-                                d0 = iso_to_date(it.get("due_date")) or today
-                                st.session_state[date_key] = d0
-
-                            # クイックボタン（+1/+3/+5年）
-                            qc1, qc2, qc3 = st.columns(3)
-                            base = today
-                            with qc1:
-                                if st.button("+1年", key=f"q1_{tmp_id}", use_container_width=True):
-                                    nd = date(base.year + 1, base.month, min(base.day, 28) if base.month == 2 else base.day)
-                                    st.session_state[date_key] = nd
-                                    it["due_date"] = nd.isoformat()
-                                    st.rerun()
-                            with qc2:
-                                if st.button("+3年", key=f"q3_{tmp_id}", use_container_width=True):
-                                    nd = date(base.year + 3, base.month, min(base.day, 28) if base.month == 2 else base.day)
-                                    st.session_state[date_key] = nd
-                                    it["due_date"] = nd.isoformat()
-                                    st.rerun()
-                            with qc3:
-                                if st.button("+5年", key=f"q5_{tmp_id}", use_container_width=True):
-                                    nd = date(base.year + 5, base.month, min(base.day, 28) if base.month == 2 else base.day)
-                                    st.session_state[date_key] = nd
-                                    it["due_date"] = nd.isoformat()
-                                    st.rerun()
-
-                            dval = st.date_input("期限日", key=date_key)
-                            it["due_date"] = dval.isoformat()
-
-                        it["memo"] = st.text_area("メモ", value=str(it.get("memo","")), key=f"memo_{tmp_id}")
+        # ---------- カート（未登録） ----------
+        elif inv_view == INV_VIEWS[1]:
+            render_cart(cat)
 
         # ---------- 登録済み ----------
-        with tab_list:
-            rows = [s for s in stocks if get_cat_key(s.get("category")) == cat]
+        else:
+            # 添字ではなく id で引く（2つのキャッシュが別々に作り直されても行を取り違えない）
+            rows_by_id = {r.get("id"): r for r in load_stocks(stocks_version)}
+            rows = [rows_by_id[i] for i in stock_ids_by_cat[cat] if i in rows_by_id]
             if not rows:
                 st.info("このカテゴリの登録済みデータはありません")
             else:
                 st.caption(f"登録済み: {len(rows)}件")
-                for s in rows:
-                    name = s.get("name","")
-                    qty = s.get("qty",0)
-                    due = s.get("due_date","")
-                    label = f"{name} (×{int(qty) if float(qty).is_integer() else qty})"
-                    if due:
-                        label += f" / {due}"
-
-                    with st.expander(label):
-                        st.write(f"単位: {s.get('unit','')}")
-                        st.write(f"期限種別: {DUE_LABEL.get(str(s.get('due_type','none')), str(s.get('due_type','none')))}")
-                        st.write(f"期限日: {s.get('due_date','')}")
-                        st.write(f"種別: {s.get('subtype','')}")
-                        st.write(f"メモ: {s.get('memo','')}")
-
-                        if st.button("削除", key=f"del_{s.get('id')}", type="secondary", use_container_width=True):
-                            db.delete_stock(s.get("id"))
-                            st.rerun()
+                labels = {s.get("id"): stock_label(s) for s in rows}
+
+                # 一覧は st.dataframe 1つで描画（並べ替え/検索はブラウザ側、行数が多くても仮想スクロール）
+                st.dataframe(
+                    stock_table(stocks_version, cat, today.isoformat(), rows),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+
+                # 削除は複数選択 + ボタン1つ（行ごとのボタンを作らない / DBも1回で削除）
+                del_ids = st.multiselect(
+                    "削除する品目",
+                    list(labels),
+                    format_func=lambda i: labels.get(i, str(i)),
+                    key=f"del_sel_{cat}",
+                )
+                if st.button("🗑️ 選択した品目を削除", key=f"del_btn_{cat}", type="secondary",
+                             use_container_width=True, disabled=not del_ids):
+                    db.delete_stocks(del_ids)
+                    st.rerun()
 
 # -----------------------
 # Data
@@ -863,7 +1231,7 @@ elif st.session_state.current_page == "data":
 
     st.download_button(
         "📥 CSV保存",
-        pd.DataFrame(stocks).to_csv(index=False).encode("utf-8-sig"),
+        stocks_csv_bytes(stocks_version, load_stocks(stocks_version)),
         file_name=f"bousai_backup_{datetime.now().strftime('%Y%m%d')}.csv",
         use_container_width=True,
     )
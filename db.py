@@ -1,9 +1,11 @@
 import os
 import sqlite3
+import threading
 import unicodedata
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 # =========================================================
 # Paths (VPS運用前提のデフォルト)
@@ -41,9 +43,13 @@ def normalize_name(name: Any) -> str:
 
 # =========================================================
 # Connection (WAL + busy_timeout)
+#   - プロセス内で DB パスごとに1本を使い回す（open + PRAGMA を毎回払わない）
+#   - Streamlit はセッションごとに別スレッドで動くので、使用中はロックで直列化する
 # =========================================================
-def get_conn() -> sqlite3.Connection:
-    db_path = _ensure_parent(get_db_path())
+_conn_lock = threading.RLock()
+_conns: Dict[str, sqlite3.Connection] = {}
+
+def _open_conn(db_path: str) -> sqlite3.Connection:
     conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
     conn.row_factory = sqlite3.Row
 
@@ -57,6 +63,22 @@ def get_conn() -> sqlite3.Connection:
     conn.execute("PRAGMA temp_store = MEMORY;")
     return conn
 
+def get_conn() -> sqlite3.Connection:
+    db_path = _ensure_parent(get_db_path())
+    with _conn_lock:
+        conn = _conns.get(db_path)
+        if conn is None:
+            conn = _conns[db_path] = _open_conn(db_path)
+        return conn
+
+@contextmanager
+def _tx() -> Iterator[sqlite3.Connection]:
+    """共有接続をロック付きで貸し出す（抜けるとき commit、例外時は rollback）"""
+    with _conn_lock:
+        conn = get_conn()
+        with conn:
+            yield conn
+
 def _has_column(conn: sqlite3.Connection, table: str, col: str) -> bool:
     cols = [r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
     return col in cols
@@ -65,7 +87,7 @@ def _has_column(conn: sqlite3.Connection, table: str, col: str) -> bool:
 # Schema
 # =========================================================
 def init_db() -> None:
-    with get_conn() as conn:
+    with _tx() as conn:
         # stocks
         conn.execute(
             """
@@ -132,6 +154,27 @@ def init_db() -> None:
             """
         )
 
+        # 在庫バージョン（stocks の行が変わるたびにトリガーで +1。アプリ側キャッシュのキーに使う）
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS meta (
+                k TEXT PRIMARY KEY,
+                v INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        conn.execute("INSERT OR IGNORE INTO meta(k, v) VALUES('stocks_ver', 0)")
+        for ev in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS trg_stocks_ver_{ev.lower()}
+                AFTER {ev} ON stocks
+                BEGIN
+                    UPDATE meta SET v = v + 1 WHERE k = 'stocks_ver';
+                END
+                """
+            )
+
         # NULL正規化（古いDB対策）
         now = _now()
         conn.execute("UPDATE stocks SET unit='' WHERE unit IS NULL")
@@ -140,6 +183,10 @@ def init_db() -> None:
         conn.execute("UPDATE stocks SET due_date='' WHERE due_date IS NULL")
         conn.execute("UPDATE stocks SET item_kind='stock' WHERE item_kind IS NULL OR item_kind=''")
         conn.execute("UPDATE stocks SET memo='' WHERE memo IS NULL")
+        # qty は数値で保持（NULL/文字列混入を一度だけ REAL に寄せ、読み出し側のキャストを不要にする）
+        conn.execute(
+            "UPDATE stocks SET qty=CAST(COALESCE(qty,0) AS REAL) WHERE typeof(qty) NOT IN ('real','integer')"
+        )
         conn.execute("UPDATE stocks SET created_at=? WHERE created_at IS NULL OR created_at=''", (now,))
         conn.execute("UPDATE stocks SET updated_at=? WHERE updated_at IS NULL OR updated_at=''", (now,))
 
@@ -178,6 +225,16 @@ def init_db() -> None:
 # =========================================================
 # Query APIs（全件取得を避ける）
 # =========================================================
+def get_stocks_version() -> int:
+    """
+    stocks テーブルの変更カウンタ（1行読むだけ）。
+    書き込み経路に関係なくトリガーで増えるので、キャッシュのキーにすれば破棄漏れがない。
+    """
+    with _tx() as conn:
+        row = conn.execute("SELECT v FROM meta WHERE k='stocks_ver'").fetchone()
+    return int(row["v"]) if row else 0
+
+
 def get_category_agg() -> Dict[str, Dict[str, float]]:
     """
     categoryごとの
@@ -186,7 +243,7 @@ def get_category_agg() -> Dict[str, Dict[str, float]]:
     をSQLで集計して返す
     """
     out: Dict[str, Dict[str, float]] = {}
-    with get_conn() as conn:
+    with _tx() as conn:
         rows = conn.execute(
             """
             SELECT COALESCE(category,'') as category,
@@ -201,7 +258,7 @@ def get_category_agg() -> Dict[str, Dict[str, float]]:
     return out
 
 def list_stocks_by_category(category: str, limit: int = 500) -> List[Dict[str, Any]]:
-    with get_conn() as conn:
+    with _tx() as conn:
         return [
             dict(r)
             for r in conn.execute(
@@ -217,7 +274,7 @@ def list_stocks_by_category(category: str, limit: int = 500) -> List[Dict[str, A
         ]
 
 def count_expired(today_iso: str) -> int:
-    with get_conn() as conn:
+    with _tx() as conn:
         r = conn.execute(
             """
             SELECT COUNT(*) as c
@@ -243,7 +300,7 @@ def bulk_upsert(items: List[Dict[str, Any]]) -> Dict[str, int]:
     updated = 0
     now = _now()
 
-    with get_conn() as conn:
+    with _tx() as conn:
         for it in items or []:
             name = normalize_name(it.get("name"))
             if not name:
@@ -338,7 +395,7 @@ def bulk_upsert(items: List[Dict[str, Any]]) -> Dict[str, int]:
 # =========================================================
 def upsert_photo(sha256_hex: str, rel_path: str, bytes_: int, width: int, height: int) -> int:
     now = _now()
-    with get_conn() as conn:
+    with _tx() as conn:
         r = conn.execute("SELECT id FROM evidence_photos WHERE sha256=?", (sha256_hex,)).fetchone()
         if r:
             return int(r["id"])
@@ -355,7 +412,7 @@ def upsert_photo(sha256_hex: str, rel_path: str, bytes_: int, width: int, height
 
 def link_photo(photo_id: int, link_type: str, link_id: str) -> None:
     now = _now()
-    with get_conn() as conn:
+    with _tx() as conn:
         conn.execute(
             """
             INSERT INTO photo_links(photo_id, link_type, link_id, created_at)
@@ -366,7 +423,7 @@ def link_photo(photo_id: int, link_type: str, link_id: str) -> None:
         conn.commit()
 
 def list_photos_for(link_type: str, link_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-    with get_conn() as conn:
+    with _tx() as conn:
         return [
             dict(r)
             for r in conn.execute(
@@ -386,12 +443,20 @@ def list_photos_for(link_type: str, link_id: str, limit: int = 50) -> List[Dict[
 # Maintenance
 # =========================================================
 def delete_stock(stock_id: int) -> None:
-    with get_conn() as conn:
-        conn.execute("DELETE FROM stocks WHERE id=?", (int(stock_id),))
+    delete_stocks([stock_id])
+
+def delete_stocks(stock_ids: List[int]) -> int:
+    """まとめて削除（1トランザクション）。戻り値: 削除件数"""
+    ids = [(int(i),) for i in stock_ids or []]
+    if not ids:
+        return 0
+    with _tx() as conn:
+        cur = conn.executemany("DELETE FROM stocks WHERE id=?", ids)
         conn.commit()
+        return int(cur.rowcount or 0)
 
 def clear_all() -> None:
-    with get_conn() as conn:
+    with _tx() as conn:
         conn.execute("DELETE FROM photo_links")
         conn.execute("DELETE FROM evidence_photos")
         conn.execute("DELETE FROM stocks")
@@ -401,7 +466,7 @@ def get_all_stocks():
     互換API: 旧app.pyが呼ぶ get_all_stocks を提供する。
     戻り値: stocks全行を list[dict] で返す。
     """
-    with get_conn() as conn:
+    with _tx() as conn:
         try:
             rows = conn.execute(
                 "SELECT * FROM stocks ORDER BY COALESCE(updated_at, created_at) DESC, id DESC"